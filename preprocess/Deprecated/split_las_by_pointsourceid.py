@@ -1,32 +1,202 @@
 import argparse
 import json
 import os
-import struct
 
 import numpy as np
 import pdal
+from numpy.lib.recfunctions import structured_to_unstructured
 
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional, pack_frame falls back to numpy
+    njit = None
 
-def run_pipeline(input_path):
-    """Run PDAL pipeline to read LAS and return a numpy structured array."""
+
+# Fields needed to build a frame; everything else is dropped after grouping.
+FRAME_FIELDS = ("X", "Y", "Z", "Red", "Green", "Blue", "Classification", "PointSourceId")
+
+# Points read per PDAL streaming chunk.
+STREAM_CHUNK_SIZE = 1_000_000
+
+# Byte sizes of the frame file sections (header, then per point XYZ and RGBA).
+HEADER_SIZE = 12
+XYZ_SIZE = 3 * 4
+RGBA_SIZE = 4 * 4
+
+
+def stream_pipeline(input_path):
+    """Run PDAL pipeline in stream mode and yield the LAS as numpy structured array chunks."""
     pipeline_json = {
         "pipeline": [
             {"type": "readers.las", "filename": input_path}
         ]
     }
     pipe = pdal.Pipeline(json.dumps(pipeline_json))
-    pipe.execute()
-    return pipe.arrays[0]
+    return pipe.iterator(chunk_size=STREAM_CHUNK_SIZE)
+
+
+def color_max(arr):
+    """Largest Red/Green/Blue value, reduced as one strided (n, 3) view instead of three passes."""
+    rgb = structured_to_unstructured(arr[['Red', 'Green', 'Blue']], copy=False)
+    return rgb.max()
+
+
+def group_by_point_source_id(arr):
+    """Sort points by PointSourceId once and return the frames as contiguous slices.
+
+    Returns the sorted unique ids, the start/stop index of each frame and a dict
+    of contiguous per-field columns (SoA) in PointSourceId order.
+    """
+    order = np.argsort(arr['PointSourceId'], kind='stable')
+    columns = {name: arr[name][order] for name in FRAME_FIELDS}
+    sorted_ids = columns['PointSourceId']
+    # A frame starts wherever the sorted id changes: one linear pass instead
+    # of np.unique (another sort) plus a binary search per frame
+    change = np.empty(sorted_ids.size, dtype=bool)
+    change[:1] = True
+    np.not_equal(sorted_ids[1:], sorted_ids[:-1], out=change[1:])
+    starts = np.flatnonzero(change)
+    point_source_ids = sorted_ids[starts]
+    stops = np.append(starts[1:], sorted_ids.size)
+    return point_source_ids, starts, stops, columns
+
+
+def stream_frames(input_path, expected_n):
+    """Stream the LAS and yield (PointSourceId, columns) as soon as each frame is complete.
+
+    Only the frames still being filled are kept in memory, instead of the whole point cloud.
+    """
+    pending = {}
+    completed = set()
+    for chunk in stream_pipeline(input_path):
+        point_source_ids, starts, stops, columns = group_by_point_source_id(chunk)
+        for pid, start, stop in zip(point_source_ids, starts, stops):
+            pid = int(pid)
+            if pid in completed:
+                raise ValueError(
+                    f"Frame {pid}: expected {expected_n} points but got more."
+                )
+
+            pieces = pending.setdefault(pid, [])
+            pieces.append({name: column[start:stop] for name, column in columns.items()})
+            n = sum(piece['PointSourceId'].size for piece in pieces)
+            if n < expected_n:
+                continue
+            if n > expected_n:
+                raise ValueError(
+                    f"Frame {pid}: expected {expected_n} points but got {n}."
+                )
 
+            del pending[pid]
+            completed.add(pid)
+            if len(pieces) == 1:
+                yield pid, pieces[0]
+            else:
+                yield pid, {name: np.concatenate([piece[name] for piece in pieces]) for name in FRAME_FIELDS}
 
-def export_frames(arr, width, height, fps, output_dir, manifest_path):
-    """Group by PointSourceId and write binary per frame."""
+    for pid, pieces in sorted(pending.items()):
+        n = sum(piece['PointSourceId'].size for piece in pieces)
+        raise ValueError(
+            f"Frame {pid}: expected {expected_n} points but got {n}."
+        )
+
+
+def scan_max_rgb(input_path):
+    """Stream the LAS once and return the largest Red/Green/Blue value."""
+    max_rgb = 0
+    for chunk in stream_pipeline(input_path):
+        max_rgb = max(max_rgb, color_max(chunk))
+    return max_rgb
+
+
+def color_lut(max_rgb):
+    """Build a 65536-entry float32 table mapping 16-bit LAS colors to 0–1."""
+    lut = np.arange(65536, dtype=np.float32)
+    # Normalize if LAS stores 0–65535 or other scaling
+    if max_rgb > 1.0:
+        np.divide(lut, np.float32(max_rgb), out=lut)
+        np.clip(lut, 0.0, 1.0, out=lut)
+    return lut
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def pack_frame_kernel(x, y, z, red, green, blue, classification, lut, xyz, rgba):
+        """Cast positions, normalize colors, compute alpha and interleave in a single pass."""
+        for i in prange(red.size):
+            xyz[i, 0] = x[i]
+            xyz[i, 1] = y[i]
+            xyz[i, 2] = z[i]
+            rgba[i, 0] = lut[red[i]]
+            rgba[i, 1] = lut[green[i]]
+            rgba[i, 2] = lut[blue[i]]
+            rgba[i, 3] = 0.0 if classification[i] == 7 else 1.0
+else:
+    pack_frame_kernel = None
+
+
+def pack_frame(subset, lut, xyz, rgba):
+    """Fill the (n × 3) XYZ and (n × 4) RGBA float32 views of a frame from its columns."""
+    if pack_frame_kernel is not None:
+        pack_frame_kernel(subset['X'], subset['Y'], subset['Z'],
+                          subset['Red'], subset['Green'], subset['Blue'],
+                          subset['Classification'], lut, xyz, rgba)
+        return
+
+    #
+    # Positions (normalized to float32)
+    #
+    xyz[:, 0] = subset['X']
+    xyz[:, 1] = subset['Y']
+    xyz[:, 2] = subset['Z']
+
+    #
+    # Colors (normalized to 0–1 float32 by table lookup into the RGBA columns)
+    #
+    np.take(lut, subset['Red'], out=rgba[:, 0], mode='clip')
+    np.take(lut, subset['Green'], out=rgba[:, 1], mode='clip')
+    np.take(lut, subset['Blue'], out=rgba[:, 2], mode='clip')
+
+    #
+    # Compute alpha based on classification
+    #
+    np.not_equal(subset['Classification'], 7, out=rgba[:, 3])
+
+
+def write_frame_file(path, buffer):
+    """Write a packed frame with raw os calls, skipping Python's buffered file layer."""
+    # O_BINARY only exists (and matters) on Windows
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        view = memoryview(buffer).cast('B')
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def export_frames(frames, width, height, fps, output_dir, manifest_path, max_rgb):
+    """Write binary per frame for the (PointSourceId, columns) frames."""
     os.makedirs(output_dir, exist_ok=True)
     os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
 
-    point_source_ids = np.unique(arr['PointSourceId'])
     expected_n = width * height
 
+    # One normalization table for the whole clip
+    lut = color_lut(max_rgb)
+
+    #
+    # Frame buffer: header (3 × uint32), XYZ float32 (n × 3), RGBA float32 (n × 4).
+    # Every frame has expected_n points, so the buffer and its header are built
+    # once and refilled per frame; each file is written before the next fill.
+    #
+    out = np.empty(HEADER_SIZE + expected_n * (XYZ_SIZE + RGBA_SIZE), dtype=np.uint8)
+    out[:HEADER_SIZE].view('<u4')[:] = (width, height, expected_n)
+    xyz = out[HEADER_SIZE:HEADER_SIZE + expected_n * XYZ_SIZE].view('<f4').reshape(expected_n, 3)
+    rgba = out[HEADER_SIZE + expected_n * XYZ_SIZE:].view('<f4').reshape(expected_n, 4)
+
+    frame_name_format = "frame_{:05d}.bin".format
+
     manifest = {
         "frames": [],
         "width": int(width),
@@ -34,9 +204,8 @@ def export_frames(arr, width, height, fps, output_dir, manifest_path):
         "fps": int(fps),
     }
 
-    for pid in point_source_ids:
-        subset = arr[arr['PointSourceId'] == pid]
-        n = subset.size
+    for pid, subset in frames:
+        n = subset['PointSourceId'].size
 
         if n != expected_n:
             raise ValueError(
@@ -44,52 +213,17 @@ def export_frames(arr, width, height, fps, output_dir, manifest_path):
             )
 
         #
-        # Positions (normalized to float32)
+        # Positions, colors (normalized to 0–1) and alpha from classification, as float32
         #
-        X = subset['X'].astype(np.float32)
-        Y = subset['Y'].astype(np.float32)
-        Z = subset['Z'].astype(np.float32)
-
-        #
-        # Colors (normalize to 0–1 float32)
-        #
-        R = subset['Red'].astype(np.float32)
-        G = subset['Green'].astype(np.float32)
-        B = subset['Blue'].astype(np.float32)
-
-        # Normalize if LAS stores 0–65535 or other scaling
-        max_rgb = max(R.max(), G.max(), B.max())
-        if max_rgb > 1.0:
-            R = np.clip(R / max_rgb, 0.0, 1.0)
-            G = np.clip(G / max_rgb, 0.0, 1.0)
-            B = np.clip(B / max_rgb, 0.0, 1.0)
-
-        #
-        # Compute alpha based on classification
-        #
-        classification = subset['Classification']
-        A = np.where(classification == 7, 0.0, 1.0).astype(np.float32)
-
-        #
-        # Stack RGBA as float32
-        #
-        rgba = np.stack([R, G, B, A], axis=1).astype('<f4')
+        pack_frame(subset, lut, xyz, rgba)
 
         #
         # Write binary file
         #
-        frame_name = f"frame_{int(pid):05d}.bin"
+        frame_name = frame_name_format(int(pid))
         frame_path = os.path.join(output_dir, frame_name)
 
-        with open(frame_path, "wb") as f:
-            # Header
-            f.write(struct.pack("<III", width, height, n))
-
-            # XYZ float32 (n × 3)
-            np.stack([X, Y, Z], axis=1).astype('<f4').tofile(f)
-
-            # RGBA float32 (n × 4)
-            rgba.tofile(f)
+        write_frame_file(frame_path, out)
 
         manifest["frames"].append({
             "id": int(pid),
@@ -97,13 +231,16 @@ def export_frames(arr, width, height, fps, output_dir, manifest_path):
             "points": int(n)
         })
 
+    # Frames are written as they complete in the stream; list them by id
+    manifest["frames"].sort(key=lambda frame: frame["id"])
+
     #
     # Write manifest JSON
     #
     with open(manifest_path, "w", encoding="utf-8") as mf:
         json.dump(manifest, mf, indent=2)
 
-    print(f"Wrote {len(point_source_ids)} frames into {output_dir}")
+    print(f"Wrote {len(manifest['frames'])} frames into {output_dir}")
     print(f"Manifest written to {manifest_path}")
 
 
@@ -118,8 +255,9 @@ def main():
 
     args = parser.parse_args()
 
-    arr = run_pipeline(args.input)
-    export_frames(arr, args.width, args.height, args.fps, args.output, args.manifest)
+    max_rgb = scan_max_rgb(args.input)
+    frames = stream_frames(args.input, args.width * args.height)
+    export_frames(frames, args.width, args.height, args.fps, args.output, args.manifest, max_rgb)
 
 
 if __name__ == "__main__":
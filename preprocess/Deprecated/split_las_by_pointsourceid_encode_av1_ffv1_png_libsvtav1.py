@@ -2,127 +2,193 @@ import argparse
 import json
 import os
 import subprocess
+import sys
 import threading
 
 import numpy as np
 import pdal
+from numpy.lib.recfunctions import repack_fields, structured_to_unstructured
+
+try:
+    import fcntl
+except ImportError:  # Windows, pipes keep their default buffer size
+    fcntl = None
+
+
+# Points read per PDAL streaming chunk.
+STREAM_CHUNK_SIZE = 1_000_000
+
+# Fields needed to build the streams; everything else is dropped while reading.
+FRAME_FIELDS = ("Z", "Red", "Green", "Blue", "Classification", "PointSourceId")
+
+# Frames ffmpeg may queue per pipe input (default 8), so a slow encoder does not
+# stall the writer threads between frames.
+PIPE_QUEUE_FRAMES = 64
+
+# Kernel buffer requested for each pipe to ffmpeg (the Linux default is 64 KiB).
+PIPE_BUFFER_SIZE = 1 << 20
 
 
 def run_pipeline(input_path):
+    # Stream the LAS in chunks and keep only FRAME_FIELDS, so the full PDAL
+    # records (intensity, GPS time, ...) are never held for the whole file
     pipeline_json = {"pipeline": [{"type": "readers.las", "filename": input_path}]}
     pipe = pdal.Pipeline(json.dumps(pipeline_json))
-    pipe.execute()
-    return pipe.arrays[0]
-
-def rgb_frame(arr, point_source_ids, width, height):
+    chunks = [
+        repack_fields(chunk[list(FRAME_FIELDS)])
+        for chunk in pipe.iterator(chunk_size=STREAM_CHUNK_SIZE)
+    ]
+    return np.concatenate(chunks)
+
+def color_max(arr):
+    # Red/Green/Blue are adjacent uint16 fields, so they are reduced as one
+    # strided (n, 3) view in a single pass instead of three
+    rgb = structured_to_unstructured(arr[["Red", "Green", "Blue"]], copy=False)
+    return rgb.max()
+
+def group_by_point_source_id(arr):
+    # Sort once by PointSourceId so every frame is a contiguous slice of
+    # SoA columns, instead of scanning the whole array once per frame.
+    order = np.argsort(arr["PointSourceId"], kind="stable")
+    columns = {name: arr[name][order] for name in FRAME_FIELDS}
+    sorted_ids = columns["PointSourceId"]
+    # A frame starts wherever the sorted id changes: one linear pass instead
+    # of np.unique (another sort) plus a binary search per frame
+    change = np.empty(sorted_ids.size, dtype=bool)
+    change[:1] = True
+    np.not_equal(sorted_ids[1:], sorted_ids[:-1], out=change[1:])
+    starts = np.flatnonzero(change)
+    point_source_ids = sorted_ids[starts]
+    stops = np.append(starts[1:], sorted_ids.size)
+    return point_source_ids, starts, stops, columns
+
+def check_frame_sizes(point_source_ids, counts, width, height):
+    # Raise for the first PointSourceId whose point count is not width * height
     expected_n = width * height
-    for i, pid in enumerate(point_source_ids):
-        subset = arr[arr["PointSourceId"] == pid]
-        n = subset.size
-
-        if n != expected_n:
-            raise ValueError(
-                f"Frame {pid}: expected {expected_n} points, got {n}"
-            )
-
+    wrong = np.flatnonzero(counts != expected_n)
+    if wrong.size:
+        i = wrong[0]
+        raise ValueError(
+            f"Frame {point_source_ids[i]}: expected {expected_n} points, got {counts[i]}"
+        )
+
+def color_lut(max_rgb):
+    # 65536-entry uint8 table mapping 16-bit LAS colors to 0–255, so each
+    # frame only does a gather instead of float scale + clip + cast.
+    if max_rgb > 1.0:
+        scale = np.float32(255.0) / np.float32(max_rgb)
+    else:
+        scale = np.float32(255.0)
+    lut = np.arange(65536, dtype=np.float32)
+    np.multiply(lut, scale, out=lut)
+    np.clip(lut, 0, 255, out=lut)
+    return lut.astype(np.uint8)
+
+def rgb_frame(frames, width, height, max_rgb):
+    point_source_ids, starts, stops, columns = frames
+    # 8-bit colors stored in 16-bit fields already span 0–255, so they only
+    # need narrowing; the table is for everything else.
+    lut = None if max_rgb == 255 else color_lut(max_rgb)
+
+    # Interleaved frame buffer reused for every frame; the pipe writer
+    # consumes it before asking the generator for the next one.
+    rgb = np.empty((height, width, 3), dtype=np.uint8)
+    rgb_points = rgb.reshape(-1, 3)
+    for i, (pid, start, stop) in enumerate(zip(point_source_ids, starts, stops)):
+        subset = {name: column[start:stop] for name, column in columns.items()}
         # ---------------------------------------------------
         # Color
         # ---------------------------------------------------
-        R = subset["Red"].astype(np.float32)
-        G = subset["Green"].astype(np.float32)
-        B = subset["Blue"].astype(np.float32)
-
-        max_rgb = max(R.max(), G.max(), B.max())
-        if max_rgb > 1.0:
-            scale = 255.0 / max_rgb
-            R = (R * scale).clip(0, 255).astype(np.uint8)
-            G = (G * scale).clip(0, 255).astype(np.uint8)
-            B = (B * scale).clip(0, 255).astype(np.uint8)
+        if lut is None:
+            rgb_points[:, 0] = subset["Red"]
+            rgb_points[:, 1] = subset["Green"]
+            rgb_points[:, 2] = subset["Blue"]
         else:
-            R = (R * 255).astype(np.uint8)
-            G = (G * 255).astype(np.uint8)
-            B = (B * 255).astype(np.uint8)
-
-        rgb = np.stack([R, G, B], axis=-1)
-        rgb_bytes = rgb.reshape(height, width, 3).tobytes()
-
-        if len(rgb_bytes) != width * height * 3:
-            raise RuntimeError("Incorrect RGB byte size.")
+            np.take(lut, subset["Red"], out=rgb_points[:, 0], mode="clip")
+            np.take(lut, subset["Green"], out=rgb_points[:, 1], mode="clip")
+            np.take(lut, subset["Blue"], out=rgb_points[:, 2], mode="clip")
 
         # ---------------------------------------------------
         # Write frame to FFmpeg
         # ---------------------------------------------------
-        yield rgb_bytes
+        yield rgb
 
-def alpha_frame(arr, point_source_ids, width, height):
-    expected_n = width * height
-    for i, pid in enumerate(point_source_ids):
-        subset = arr[arr["PointSourceId"] == pid]
-        n = subset.size
-
-        if n != expected_n:
-            raise ValueError(
-                f"Frame {pid}: expected {expected_n} points, got {n}"
-            )
+def alpha_frame(frames, width, height):
+    point_source_ids, starts, stops, columns = frames
 
+    # Reused for every frame, see rgb_frame
+    alpha = np.empty((height, width), dtype=np.uint8)
+    alpha_points = alpha.reshape(-1)
+    for i, (pid, start, stop) in enumerate(zip(point_source_ids, starts, stops)):
+        subset = {name: column[start:stop] for name, column in columns.items()}
         # ---------------------------------------------------
         # Alpha mask
         # ---------------------------------------------------
         classification = subset["Classification"]
-        A = np.where(classification == 7, 0, 255).astype(np.uint8)
-
-        a = np.stack([A], axis=-1)
-        a_bytes = a.reshape(height, width, 1).tobytes()
-
-        if len(a_bytes) != width * height * 1:
-            raise RuntimeError("Incorrect A byte size.")
+        np.not_equal(classification, 7, out=alpha_points)
+        alpha_points *= 255
 
         # ---------------------------------------------------
         # Write both frames to FFmpeg
         # ---------------------------------------------------
-        yield a_bytes
+        yield alpha
 
-def depth_frame(arr, point_source_ids, width, height, depth_scale_factor):
+def depth_frame(frames, width, height, depth_scale_factor):
     expected_n = width * height
-    for i, pid in enumerate(point_source_ids):
-        subset = arr[arr["PointSourceId"] == pid]
-        n = subset.size
-
-        if n != expected_n:
-            raise ValueError(
-                f"Frame {pid}: expected {expected_n} points, got {n}"
-            )
-
+    point_source_ids, starts, stops, columns = frames
+
+    # Scratch and frame buffers reused for every frame, see rgb_frame
+    depth_m = np.empty(expected_n, dtype=np.float32)
+    depth_16 = np.empty((height, width), dtype=np.uint16)
+    depth_scale_factor = np.float32(depth_scale_factor)
+    for i, (pid, start, stop) in enumerate(zip(point_source_ids, starts, stops)):
+        subset = {name: column[start:stop] for name, column in columns.items()}
         # ---------------------------------------------------
         # Depth frame (true 16-bit)
         # ---------------------------------------------------
-        depth_m = np.abs(subset["Z"].astype(np.float32))
-        depth_16 = np.clip(depth_m * depth_scale_factor, 0, 65535).astype(np.uint16)
-        depth_frame = depth_16.reshape(height, width)
-
-        depth_bytes = depth_frame.tobytes()
-        if len(depth_bytes) != width * height * 2:
-            raise RuntimeError("Incorrect depth byte size.")
+        np.abs(subset["Z"], out=depth_m, casting="same_kind")
+        np.multiply(depth_m, depth_scale_factor, out=depth_m)
+        # abs already made it non-negative, so only the upper bound is left
+        np.minimum(depth_m, 65535, out=depth_m)
+        depth_16.reshape(-1)[:] = depth_m
 
         if i ==0:
             print("\n")
             print(i)
             print("\n")
-            for b in depth_16[:16]:
+            for b in depth_16.reshape(-1)[:16]:
                 print(f"{b}", end=" ")
 
         # ---------------------------------------------------
         # Write both frames to FFmpeg
         # ---------------------------------------------------
-        yield depth_bytes
+        yield depth_16
+
+def grow_pipe_buffer(fd):
+    """Raise the kernel buffer of pipe fd to PIPE_BUFFER_SIZE where Linux allows it."""
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return
+    try:
+        # F_SETPIPE_SZ is only exported by fcntl from Python 3.10
+        fcntl.fcntl(fd, getattr(fcntl, "F_SETPIPE_SZ", 1031), PIPE_BUFFER_SIZE)
+    except OSError:
+        # Above /proc/sys/fs/pipe-max-size for this user; keep the default
+        pass
 
 def write_to_pipe(pipe_name, frames_bytes):
     print(f"Starting write to {pipe_name}...")
     try:
-        # Open the pipe in write-binary mode
-        with open(pipe_name, 'wb') as f:
+        # Write straight to the pipe fd; frames are far larger than the
+        # BufferedWriter buffer, so it would only add a layer per write
+        fd = os.open(pipe_name, os.O_WRONLY)
+        grow_pipe_buffer(fd)
+        try:
             for frame_bytes in frames_bytes:
-                f.write(frame_bytes)
+                view = memoryview(frame_bytes).cast("B")
+                while view:
+                    view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
     except BrokenPipeError:
         print(f"Pipe {pipe_name} was closed by the reader (ffmpeg) prematurely.")
     except Exception as e:
@@ -135,7 +201,8 @@ def encode_color_alpha_depth_streams(
     height,
     fps,
     output_dir,
-    manifest_path
+    manifest_path,
+    max_rgb
 ):
 
     print("--- Starting Triple Stream Encoding (Color + Alpha + Depth) ---")
@@ -146,7 +213,10 @@ def encode_color_alpha_depth_streams(
     file_name = "ColorAlphaDepth.mkv"
     file_path = os.path.join(output_dir, file_name)
 
-    point_source_ids = np.unique(arr["PointSourceId"])
+    frames = group_by_point_source_id(arr)
+    point_source_ids = frames[0]
+    # Every frame must fill the image; check them all before ffmpeg starts
+    check_frame_sizes(point_source_ids, frames[2] - frames[1], width, height)
 
     # Find max depth to calculate scale factor for full 16-bit range
     max_depth = np.abs(arr["Z"]).max()
@@ -179,6 +249,7 @@ def encode_color_alpha_depth_streams(
         "-pix_fmt", "rgb24",
         "-s", f"{width}x{height}",
         "-framerate", str(fps),
+        "-thread_queue_size", str(PIPE_QUEUE_FRAMES),
         "-i", pipe1_path,
 
         # ---------- Alpha INPUT ----------
@@ -186,6 +257,7 @@ def encode_color_alpha_depth_streams(
         "-pix_fmt", "gray", # 8-bit grayscale
         "-s", f"{width}x{height}",
         "-framerate", str(fps),
+        "-thread_queue_size", str(PIPE_QUEUE_FRAMES),
         "-i", pipe2_path,
 
         # ---------- DEPTH INPUT ----------
@@ -193,18 +265,18 @@ def encode_color_alpha_depth_streams(
         "-pix_fmt", "gray16le",
         "-s", f"{width}x{height}",
         "-framerate", str(fps),
+        "-thread_queue_size", str(PIPE_QUEUE_FRAMES),
         "-i", pipe3_path,
 
-        "-filter_complex",
-        (
-            "[0:v]format=yuv420p[color]"
-        ),
-
         # ---------- Stream 0: Color - AV1 ----------
-        "-map", "[color]",
+        # The encoder-side pix_fmt does the rgb24 -> yuv420p conversion, so
+        # no filter graph is needed
+        "-map", "0:v",
         "-c:v:0", "libsvtav1",
+        "-pix_fmt:v:0", "yuv420p",
         "-preset", "5",
         "-crf", "35",
+        "-svtav1-params:v:0", "tile-columns=1",
 
         # ---------- Stream 1: Alpha - FFV1 (GRAY) ----------
         "-map", "1:v",
@@ -231,9 +303,9 @@ def encode_color_alpha_depth_streams(
         text=False
     )
 
-    rgb_frame_generator = rgb_frame(arr, point_source_ids, width, height)
-    alpha_frame_generator = alpha_frame(arr, point_source_ids, width, height)
-    depth_frame_generator = depth_frame(arr, point_source_ids, width, height, depth_scale_factor)
+    rgb_frame_generator = rgb_frame(frames, width, height, max_rgb)
+    alpha_frame_generator = alpha_frame(frames, width, height)
+    depth_frame_generator = depth_frame(frames, width, height, depth_scale_factor)
 
     # Start separate threads to write data to the pipes
     t1 = threading.Thread(target=write_to_pipe, args=(pipe1_path, rgb_frame_generator))
@@ -295,9 +367,16 @@ def main():
     args = parser.parse_args()
 
     arr = run_pipeline(args.input)
-    encode_color_alpha_depth_streams(
-        arr, args.width, args.height, args.fps, args.output, args.manifest
-    )
+
+    # One color scale for the whole clip, so frames don't flicker
+    max_rgb = float(color_max(arr))
+    try:
+        encode_color_alpha_depth_streams(
+            arr, args.width, args.height, args.fps, args.output, args.manifest, max_rgb
+        )
+    except ValueError as e:
+        # Raised by check_frame_sizes before ffmpeg is started
+        print(f"Error: {e}")
 
 if __name__ == "__main__":
     main()
@@ -1,22 +1,305 @@
 import argparse
 import json
 import os
+import queue
 import subprocess
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pdal
+from numpy.lib.recfunctions import repack_fields, structured_to_unstructured
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional, prepare_frame falls back to numpy
+    njit = None
+
+try:
+    import fcntl
+except ImportError:  # Windows, pipes keep their default buffer size
+    fcntl = None
+
+
+MAX_8BIT = 255
+
+# Frames are prepared by a thread pool (numpy releases the GIL) while the
+# main thread writes the previous ones to ffmpeg's stdin.
+MAX_WORKERS = 4
+MAX_PENDING_FRAMES = MAX_WORKERS
+
+# Prepared frames each writer thread may have queued behind the one it writes.
+WRITER_QUEUE_FRAMES = 2
+
+# Points read per PDAL streaming chunk.
+STREAM_CHUNK_SIZE = 1_000_000
+
+# Fields needed to build the frames; the rest of the PDAL record is dropped while reading.
+FRAME_FIELDS = ("Z", "Red", "Green", "Blue", "Classification", "PointSourceId")
+
+# Points per band of rows packed at once by the numpy fallback: a band's input
+# columns, temporaries and output bytes (about 32 per point) then fit in a
+# 256 KiB L2 cache instead of every pass streaming the whole frame from memory.
+TILE_POINTS = 256 * 1024 // 32
+
+# Frames ffmpeg may queue per pipe input (default 8), so a slow encoder does not
+# stall the writes between frames.
+PIPE_QUEUE_FRAMES = 64
+
+# Kernel buffer requested for each pipe to ffmpeg (the Linux default is 64 KiB).
+PIPE_BUFFER_SIZE = 1 << 20
 
 
 def run_pipeline(input_path):
-    """Run PDAL pipeline to read LAS and return a numpy structured array."""
+    """
+    Stream the LAS through PDAL in chunks and return a structured array of
+    FRAME_FIELDS only, so the full records are never held for the whole file
+    """
     pipeline_json = {
         "pipeline": [
             {"type": "readers.las", "filename": input_path}
         ]
     }
     pipe = pdal.Pipeline(json.dumps(pipeline_json))
-    pipe.execute()
-    return pipe.arrays[0]
+    chunks = [
+        repack_fields(chunk[list(FRAME_FIELDS)])
+        for chunk in pipe.iterator(chunk_size=STREAM_CHUNK_SIZE)
+    ]
+    return np.concatenate(chunks)
+
+
+def color_max(arr):
+    """Largest Red/Green/Blue value, reduced as one strided (n, 3) view instead of three passes."""
+    rgb = structured_to_unstructured(arr[['Red', 'Green', 'Blue']], copy=False)
+    return rgb.max()
+
+
+def sort_by_point_source_id(arr):
+    """
+    Sort once by PointSourceId into plain contiguous FRAME_FIELDS columns,
+    so each frame is a unit-stride slice instead of a masked copy of every field
+    """
+    order = np.argsort(arr['PointSourceId'], kind='stable')
+    columns = {name: arr[name][order] for name in FRAME_FIELDS}
+    sorted_ids = columns['PointSourceId']
+    # A frame starts wherever the sorted id changes: one linear pass instead
+    # of np.unique (another sort) plus a binary search per frame
+    change = np.empty(sorted_ids.size, dtype=bool)
+    change[:1] = True
+    np.not_equal(sorted_ids[1:], sorted_ids[:-1], out=change[1:])
+    starts = np.flatnonzero(change)
+    point_source_ids = sorted_ids[starts]
+    bounds = np.append(starts, sorted_ids.size)
+    return point_source_ids, bounds, columns
+
+
+def check_frame_sizes(point_source_ids, counts, width, height):
+    """Raise for the first PointSourceId whose point count is not width * height."""
+    expected_n = width * height
+    wrong = np.flatnonzero(counts != expected_n)
+    if wrong.size:
+        i = wrong[0]
+        raise ValueError(
+            f"Frame {point_source_ids[i]}: expected {expected_n} points but got {counts[i]}."
+        )
+
+
+def scale_color(channel, max_rgb, out, scratch=None):
+    """
+    Normalize a 16-bit LAS color channel to 0–255 into the uint8 array out,
+    using the float32 array scratch (same shape) for the general scale
+    """
+    if max_rgb == 65_535:
+        # Full 16-bit range: the high byte is the 8-bit color
+        np.right_shift(channel, 8, out=out, casting='unsafe')
+    elif max_rgb == MAX_8BIT or max_rgb <= 1.0:
+        # Already 0–255 (8-bit colors in 16-bit fields), or left as is
+        out[...] = channel
+    else:
+        # Dividing by the clip maximum already lands in 0–1, so no clipping
+        scaled = np.divide(channel, np.float32(max_rgb), out=scratch, dtype=np.float32)
+        np.multiply(scaled, 255, out=scaled)
+        np.copyto(out, scaled, casting='unsafe')
+    return out
+
+
+def color_lut(max_rgb):
+    """scale_color of every 16-bit value, so the compiled kernel only does a lookup."""
+    return scale_color(np.arange(65536, dtype=np.uint16), max_rgb, np.empty(65536, dtype=np.uint8))
+
+
+if njit is not None:
+    # nogil rather than parallel: the worker pool already runs one frame per
+    # thread, and numba's default threading layer rejects concurrent launches
+    @njit(nogil=True, cache=True)
+    def pack_frame_kernel(z, red, green, blue, classification, lut, combined_array):
+        """Scale and split depth, compute alpha, normalize colors and interleave in a single pass."""
+        height, double_width, _ = combined_array.shape
+        width = double_width // 2
+        for row in range(height):
+            for col in range(width):
+                i = row * width + col
+                d = np.uint32(min(abs(np.float32(z[i]) * np.float32(1000.0)), np.float32(65_535.0)))
+                combined_array[row, col, 0] = 0 if classification[i] == 7 else 255
+                combined_array[row, col, 1] = (d >> 8) & 0xFF
+                combined_array[row, col, 2] = d & 0xFF
+                combined_array[row, width + col, 0] = lut[red[i]]
+                combined_array[row, width + col, 1] = lut[green[i]]
+                combined_array[row, width + col, 2] = lut[blue[i]]
+else:
+    pack_frame_kernel = None
+
+
+def pack_tile(tile, max_rgb, combined_array, scratch, depth):
+    """
+    Fill a band of rows of the frame (combined_array) from the points of tile,
+    the same rows of the subset, using the float32 scratch and '>u4' depth
+    arrays of the band
+    """
+    height, double_width, _ = combined_array.shape
+    width = double_width // 2
+
+    # Depth
+    # Split 16 bit variable into 2x8-bit channels (G, B) 
+    # Scaled in the float32 scratch and truncated into the big-endian depth
+    # scratch, so no frame-sized temporaries (tile['Z'] is a view of the column)
+    Z = depth.reshape(-1)
+    z_scaled = scratch.reshape(-1)
+    np.multiply(tile['Z'], 1000.0, out=z_scaled, dtype=np.float32)
+    np.abs(z_scaled, out=z_scaled)
+    # abs already made it non-negative, so only the upper bound is left
+    np.minimum(z_scaled, 65_535, out=z_scaled)
+    np.copyto(Z, z_scaled, casting='unsafe')
+
+    # Big-endian bytes of each value, so the channels below are views, not shift passes
+    Z_bytes = Z.view(np.uint8).reshape(-1, 4)
+
+    # 8 MSBs -> Red Channel
+    # Z_R = Z_bytes[:, 1]
+
+    # Middle 8 bits -> Green Channel
+    Z_G = Z_bytes[:, 2]
+
+    # 8 LSBs -> Blue Channel
+    Z_B = Z_bytes[:, 3]
+
+    # Colors, written straight into the right half of the frame
+    color_array = combined_array[:, width:]
+    channels = (tile['Red'], tile['Green'], tile['Blue'])
+
+    # Normalize if LAS stores 0–65535 or other scaling (max_rgb is per clip)
+    for k, channel in enumerate(channels):
+        scale_color(channel.reshape((height, width)), max_rgb, color_array[:, :, k], scratch)
+
+    # Numpy array (H, 2*W, 3), filled channel by channel: depth on the
+    # left half (color is already in the right), with no stack or concatenate copies
+    combined_array[:, :width, 1] = Z_G.reshape((height, width))
+    combined_array[:, :width, 2] = Z_B.reshape((height, width))
+
+    # Alpha based on classification, stored in Red channel as 0/255 bytes
+    A_R = combined_array[:, :width, 0]
+    np.not_equal(tile['Classification'].reshape((height, width)), 7, out=A_R)
+    A_R *= MAX_8BIT
+
+
+def tile_rows(width, height):
+    """Rows per band of the numpy fallback, about TILE_POINTS points."""
+    return min(height, max(1, TILE_POINTS // width))
+
+
+def prepare_frame(subset, width, height, max_rgb, lut, combined_array, scratch, depth):
+    """Fill the preallocated (H, 2*W, 3) frame for one PointSourceId and return a byte view of it."""
+    if pack_frame_kernel is not None:
+        pack_frame_kernel(subset['Z'], subset['Red'], subset['Green'], subset['Blue'],
+                          subset['Classification'], lut, combined_array)
+        return memoryview(combined_array).cast('B')
+
+    # numpy fallback, a band of rows at a time so each band stays in cache
+    rows = tile_rows(width, height)
+    for top in range(0, height, rows):
+        bottom = min(top + rows, height)
+        tile = {name: column[top * width:bottom * width] for name, column in subset.items()}
+        pack_tile(tile, max_rgb, combined_array[top:bottom], scratch[:bottom - top],
+                  depth[:bottom - top])
+
+    # Zero-copy byte view of the NumPy array (H, 2*W, 3) (RGB format)
+    return memoryview(combined_array).cast('B')
+
+
+def prepared_frames(executor, frames, width, height, max_rgb):
+    """
+    Yield the raw frames in order while the executor prepares up to
+    MAX_PENDING_FRAMES ahead, so numpy work overlaps the ffmpeg writes
+    """
+    point_source_ids, bounds, columns = frames
+    # The compiled kernel normalizes colors through one table for the clip
+    lut = color_lut(max_rgb) if pack_frame_kernel is not None else None
+    # Frame buffers reused round-robin. The writers get views, not copies, so a
+    # buffer is busy from submission until written: up to MAX_PENDING_FRAMES
+    # futures (the new one included), WRITER_QUEUE_FRAMES queued and one being
+    # written
+    buffers = [
+        np.empty((height, 2 * width, 3), dtype=np.uint8)
+        for _ in range(MAX_PENDING_FRAMES + WRITER_QUEUE_FRAMES + 1)
+    ]
+    # Written as flat byte views (memoryview(...).cast('B')), which needs each
+    # buffer to be one C-contiguous block rather than a strided copy
+    assert all(buffer.flags['C_CONTIGUOUS'] for buffer in buffers)
+    # float32 and depth band scratch for the numpy path, only needed while a
+    # frame is being prepared, so one pair per pending future is enough
+    rows = tile_rows(width, height)
+    scratches = [
+        (np.empty((rows, width), dtype=np.float32), np.empty((rows, width), dtype='>u4'))
+        if pack_frame_kernel is None else (None, None)
+        for _ in range(MAX_PENDING_FRAMES + 1)
+    ]
+    pending = deque()
+    for i in range(point_source_ids.size):
+        lo, hi = bounds[i], bounds[i + 1]
+        subset = {name: column[lo:hi] for name, column in columns.items()}
+        combined_array = buffers[i % len(buffers)]
+        scratch, depth = scratches[i % len(scratches)]
+        pending.append(executor.submit(
+            prepare_frame, subset, width, height, max_rgb, lut, combined_array,
+            scratch, depth))
+        if len(pending) >= MAX_PENDING_FRAMES:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def grow_pipe_buffer(fd):
+    """Raise the kernel buffer of pipe fd to PIPE_BUFFER_SIZE where Linux allows it."""
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return
+    try:
+        # F_SETPIPE_SZ is only exported by fcntl from Python 3.10
+        fcntl.fcntl(fd, getattr(fcntl, "F_SETPIPE_SZ", 1031), PIPE_BUFFER_SIZE)
+    except OSError:
+        # Above /proc/sys/fs/pipe-max-size for this user; keep the default
+        pass
+
+
+def write_to_stdin(stdin, frames_bytes):
+    """
+    Write the frames to ffmpeg's stdin from a dedicated thread, so a pipe
+    blocked by the encoder does not hold up preparing the next frames
+    """
+    try:
+        for frame_bytes in frames_bytes:
+            # stdin is unbuffered, so a write may be partial
+            view = memoryview(frame_bytes).cast("B")
+            while view:
+                view = view[stdin.write(view):]
+    except BrokenPipeError:
+        print("FFmpeg closed its stdin prematurely.")
+    except Exception as e:
+        print(f"Error writing to FFmpeg's stdin: {e}")
+    # Keep draining so the producer never blocks on a full queue
+    for _ in frames_bytes:
+        pass
 
 
 def encode_multiple_frames_with_alpha_to_av1(
@@ -25,7 +308,8 @@ def encode_multiple_frames_with_alpha_to_av1(
         height,
         fps,
         output_dir,
-        manifest_path):
+        manifest_path,
+        max_rgb):
     """
     Group by PointSourceId to get a sequence of RGBAZ frames 
     and encodes the frames as an 8-bit AV1 video file using the yuva444p format
@@ -37,11 +321,12 @@ def encode_multiple_frames_with_alpha_to_av1(
     os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
 
     # Prepare some variables
-    point_source_ids = np.unique(arr['PointSourceId'])
-    expected_n = width * height
+    frames = sort_by_point_source_id(arr)
+    point_source_ids = frames[0]
+    # Every frame must fill the image; check them all before ffmpeg starts
+    check_frame_sizes(point_source_ids, np.diff(frames[1]), width, height)
     file_name = "RGBAZ.webm"
     file_path = os.path.join(output_dir, file_name)
-    MAX_8BIT = 255
 
     # Define FFmpeg Command
     ffmpeg_command = [
@@ -55,6 +340,8 @@ def encode_multiple_frames_with_alpha_to_av1(
         f"{2*width}x{height}",
         "-framerate",
         str(fps),
+        "-thread_queue_size",
+        str(PIPE_QUEUE_FRAMES),
         "-i",
         "pipe:0",  # Read raw data from standard input
         "-c:v",
@@ -84,67 +371,31 @@ def encode_multiple_frames_with_alpha_to_av1(
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=None,
+            # Unbuffered: the frames are written straight from their ring buffers
+            bufsize=0,
+        )
+        grow_pipe_buffer(process.stdin.fileno())
+
+        # A writer thread owns stdin, so frames keep being prepared while
+        # ffmpeg holds the pipe
+        stdin_frames = queue.Queue(maxsize=WRITER_QUEUE_FRAMES)
+        stdin_thread = threading.Thread(
+            target=write_to_stdin, args=(process.stdin, iter(stdin_frames.get, None))
         )
+        stdin_thread.start()
 
-        for i, pid in enumerate(point_source_ids):
-            subset = arr[arr['PointSourceId'] == pid]
-            n = subset.size
-
-            if n != expected_n:
-                raise ValueError(
-                    f"Frame {pid}: expected {expected_n} points but got {n}."
-                )
-
-            # Depth
-            # Split 16 bit variable into 2x8-bit channels (G, B) 
-            Z = np.clip(np.abs(subset['Z'].astype(np.float32) * 1000.0), 0, 65_535).astype(np.uint32)
-            
-            # 8 MSBs -> Red Channel
-            # Z_R = ((Z >> 16) & MAX_8BIT).astype(np.uint8)
-
-            # Middle 8 bits -> Green Channel
-            Z_G = ((Z >> 8) & MAX_8BIT).astype(np.uint8)
-            
-            # 8 LSBs -> Blue Channel
-            Z_B = (Z & MAX_8BIT).astype(np.uint8)
-            
-            # Colors
-            R = subset['Red'].astype(np.float32)
-            G = subset['Green'].astype(np.float32)
-            B = subset['Blue'].astype(np.float32)
-
-            # Normalize if LAS stores 0–65535 or other scaling
-            max_rgb = max(R.max(), G.max(), B.max())
-            if max_rgb > 1.0:
-                R = np.clip(np.clip(R / max_rgb, 0.0, 1.0) * 255, 0, 255).astype(np.uint8)
-                G = np.clip(np.clip(G / max_rgb, 0.0, 1.0) * 255, 0, 255).astype(np.uint8)
-                B = np.clip(np.clip(B / max_rgb, 0.0, 1.0) * 255, 0, 255).astype(np.uint8)
-
-            # Compute alpha based on classification and store in Red channel
-            classification = subset['Classification']
-            A_R = np.clip(np.where(classification == 7, 0.0, 1.0).astype(np.float32) * 255, 0, 255).astype(np.uint8)
-
-            # Numpy array (H, W, 3)
-            AZZ_stacked_array = np.stack([A_R, Z_G, Z_B], axis=0)
-            AZZ_transposed_array = np.transpose(AZZ_stacked_array)
-            AZZ_final_image_array = AZZ_transposed_array.reshape((height, width, 3))
-
-            # Numpy array (H, W, 3)
-            RGB_stacked_array = np.stack([R, G, B], axis=0)
-            RGB_transposed_array = np.transpose(RGB_stacked_array)
-            RGB_final_image_array = RGB_transposed_array.reshape((height, width, 3))
-
-            # Numpy array (H, 2*W, 3)
-            combined_array = np.concatenate((AZZ_final_image_array, RGB_final_image_array), axis=1)
-
-            # Convert the NumPy array (H, 2*W, 3) to raw bytes (RGB format)
-            raw_frame_bytes = combined_array.tobytes()
-
-            # Write the raw frame data to FFmpeg's stdin pipe
-            process.stdin.write(raw_frame_bytes)
-
-            if (i + 1) % (fps * 2) == 0:
-                print(f"  Piped {i + 1} frames...")
+        try:
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                raw_frames = prepared_frames(executor, frames, width, height, max_rgb)
+                for i, raw_frame_bytes in enumerate(raw_frames):
+                    # Hand the raw frame data to the stdin writer
+                    stdin_frames.put(raw_frame_bytes)
+
+                    if (i + 1) % (fps * 2) == 0:
+                        print(f"  Piped {i + 1} frames...")
+        finally:
+            stdin_frames.put(None)
+            stdin_thread.join()
 
         # Finalize and Close
         process.stdin.close()
@@ -186,8 +437,15 @@ def main():
     args = parser.parse_args()
 
     arr = run_pipeline(args.input)
-    encode_multiple_frames_with_alpha_to_av1(
-        arr, args.width, args.height, args.fps, args.output, args.manifest)
+
+    # One color scale for the whole clip, so frames don't flicker
+    max_rgb = float(color_max(arr))
+    try:
+        encode_multiple_frames_with_alpha_to_av1(
+            arr, args.width, args.height, args.fps, args.output, args.manifest, max_rgb)
+    except ValueError as e:
+        # Raised by check_frame_sizes before ffmpeg is started
+        print(f"Error: {e}")
 
 
 if __name__ == "__main__":
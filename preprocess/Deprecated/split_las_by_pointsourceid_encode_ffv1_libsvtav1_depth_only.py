@@ -2,39 +2,89 @@ import argparse
 import json
 import os
 import subprocess
+import sys
 import threading
 
 import numpy as np
 import pdal
+from numpy.lib.recfunctions import repack_fields
+
+try:
+    import fcntl
+except ImportError:  # Windows, pipes keep their default buffer size
+    fcntl = None
+
+
+# Points read per PDAL streaming chunk.
+STREAM_CHUNK_SIZE = 1_000_000
+
+# Fields needed to build the streams; everything else is dropped while reading.
+FRAME_FIELDS = ("Z", "PointSourceId")
+
+# Frames ffmpeg may queue per pipe input (default 8), so a slow encoder does not
+# stall the writer threads between frames.
+PIPE_QUEUE_FRAMES = 64
+
+# Kernel buffer requested for each pipe to ffmpeg (the Linux default is 64 KiB).
+PIPE_BUFFER_SIZE = 1 << 20
 
 
 def run_pipeline(input_path):
+    # Stream the LAS in chunks and keep only FRAME_FIELDS, so the full PDAL
+    # records (intensity, GPS time, ...) are never held for the whole file
     pipeline_json = {"pipeline": [{"type": "readers.las", "filename": input_path}]}
     pipe = pdal.Pipeline(json.dumps(pipeline_json))
-    pipe.execute()
-    return pipe.arrays[0]
-
-def depth_frame(arr, point_source_ids, width, height, depth_scale_factor):
+    chunks = [
+        repack_fields(chunk[list(FRAME_FIELDS)])
+        for chunk in pipe.iterator(chunk_size=STREAM_CHUNK_SIZE)
+    ]
+    return np.concatenate(chunks)
+
+def group_by_point_source_id(arr):
+    # Sort once by PointSourceId so every frame is a contiguous slice of
+    # SoA columns, instead of scanning the whole array once per frame.
+    order = np.argsort(arr["PointSourceId"], kind="stable")
+    columns = {name: arr[name][order] for name in FRAME_FIELDS}
+    sorted_ids = columns["PointSourceId"]
+    # A frame starts wherever the sorted id changes: one linear pass instead
+    # of np.unique (another sort) plus a binary search per frame
+    change = np.empty(sorted_ids.size, dtype=bool)
+    change[:1] = True
+    np.not_equal(sorted_ids[1:], sorted_ids[:-1], out=change[1:])
+    starts = np.flatnonzero(change)
+    point_source_ids = sorted_ids[starts]
+    stops = np.append(starts[1:], sorted_ids.size)
+    return point_source_ids, starts, stops, columns
+
+def check_frame_sizes(point_source_ids, counts, width, height):
+    # Raise for the first PointSourceId whose point count is not width * height
     expected_n = width * height
-    for i, pid in enumerate(point_source_ids):
-        subset = arr[arr["PointSourceId"] == pid]
-        n = subset.size
-
-        if n != expected_n:
-            raise ValueError(
-                f"Frame {pid}: expected {expected_n} points, got {n}"
-            )
-
+    wrong = np.flatnonzero(counts != expected_n)
+    if wrong.size:
+        i = wrong[0]
+        raise ValueError(
+            f"Frame {point_source_ids[i]}: expected {expected_n} points, got {counts[i]}"
+        )
+
+def depth_frame(frames, width, height, depth_scale_factor):
+    expected_n = width * height
+    point_source_ids, starts, stops, columns = frames
+
+    # Scratch and frame buffers reused for every frame; the pipe writer
+    # consumes the frame before asking the generator for the next one.
+    depth_m = np.empty(expected_n, dtype=np.float32)
+    depth_16 = np.empty((height, width), dtype=np.uint16)
+    depth_scale_factor = np.float32(depth_scale_factor)
+    for i, (pid, start, stop) in enumerate(zip(point_source_ids, starts, stops)):
+        subset = {name: column[start:stop] for name, column in columns.items()}
         # ---------------------------------------------------
         # Depth frame (true 16-bit)
         # ---------------------------------------------------
-        depth_m = np.abs(subset["Z"].astype(np.float32))
-        depth_16 = np.clip(depth_m * depth_scale_factor, 0, 65535).astype(np.uint16)
-        depth_frame = depth_16.reshape(height, width)
-
-        depth_bytes = depth_frame.tobytes()
-        if len(depth_bytes) != width * height * 2:
-            raise RuntimeError("Incorrect depth byte size.")
+        np.abs(subset["Z"], out=depth_m, casting="same_kind")
+        np.multiply(depth_m, depth_scale_factor, out=depth_m)
+        # abs already made it non-negative, so only the upper bound is left
+        np.minimum(depth_m, 65535, out=depth_m)
+        depth_16.reshape(-1)[:] = depth_m
 
         if i ==0:
             #print("\n")
@@ -44,7 +94,7 @@ def depth_frame(arr, point_source_ids, width, height, depth_scale_factor):
             #    print(f"{b}", end=" ")
 
             import struct
-            vals = struct.unpack("<16H", depth_bytes[:32])
+            vals = struct.unpack("<16H", memoryview(depth_16).cast("B")[:32])
             for v in vals:
                 print(f"{v:04x}", end=" ")
             print()
@@ -52,15 +102,33 @@ def depth_frame(arr, point_source_ids, width, height, depth_scale_factor):
         # ---------------------------------------------------
         # Write both frames to FFmpeg
         # ---------------------------------------------------
-        yield depth_bytes
+        yield depth_16
+
+def grow_pipe_buffer(fd):
+    """Raise the kernel buffer of pipe fd to PIPE_BUFFER_SIZE where Linux allows it."""
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return
+    try:
+        # F_SETPIPE_SZ is only exported by fcntl from Python 3.10
+        fcntl.fcntl(fd, getattr(fcntl, "F_SETPIPE_SZ", 1031), PIPE_BUFFER_SIZE)
+    except OSError:
+        # Above /proc/sys/fs/pipe-max-size for this user; keep the default
+        pass
 
 def write_to_pipe(pipe_name, frames_bytes):
     print(f"Starting write to {pipe_name}...")
     try:
-        # Open the pipe in write-binary mode
-        with open(pipe_name, 'wb') as f:
+        # Write straight to the pipe fd; frames are far larger than the
+        # BufferedWriter buffer, so it would only add a layer per write
+        fd = os.open(pipe_name, os.O_WRONLY)
+        grow_pipe_buffer(fd)
+        try:
             for frame_bytes in frames_bytes:
-                f.write(frame_bytes)
+                view = memoryview(frame_bytes).cast("B")
+                while view:
+                    view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
     except BrokenPipeError:
         print(f"Pipe {pipe_name} was closed by the reader (ffmpeg) prematurely.")
     except Exception as e:
@@ -84,7 +152,10 @@ def encode_color_alpha_depth_streams(
     file_name = "ColorAlphaDepth.mkv"
     file_path = os.path.join(output_dir, file_name)
 
-    point_source_ids = np.unique(arr["PointSourceId"])
+    frames = group_by_point_source_id(arr)
+    point_source_ids = frames[0]
+    # Every frame must fill the image; check them all before ffmpeg starts
+    check_frame_sizes(point_source_ids, frames[2] - frames[1], width, height)
 
     # Find max depth to calculate scale factor for full 16-bit range
     max_depth = np.abs(arr["Z"]).max()
@@ -113,6 +184,7 @@ def encode_color_alpha_depth_streams(
         "-pix_fmt", "gray16le",
         "-s", f"{width}x{height}",
         "-framerate", str(fps),
+        "-thread_queue_size", str(PIPE_QUEUE_FRAMES),
         "-i", pipe3_path,
 
         # ---------- Stream 2: Depth - FFV1 (GRAY16LE) ----------
@@ -136,7 +208,7 @@ def encode_color_alpha_depth_streams(
     )
 
     
-    depth_frame_generator = depth_frame(arr, point_source_ids, width, height, depth_scale_factor)
+    depth_frame_generator = depth_frame(frames, width, height, depth_scale_factor)
 
     # Start separate threads to write data to the pipes
     t3 = threading.Thread(target=write_to_pipe, args=(pipe3_path, depth_frame_generator))
@@ -190,9 +262,13 @@ def main():
     args = parser.parse_args()
 
     arr = run_pipeline(args.input)
-    encode_color_alpha_depth_streams(
-        arr, args.width, args.height, args.fps, args.output, args.manifest
-    )
+    try:
+        encode_color_alpha_depth_streams(
+            arr, args.width, args.height, args.fps, args.output, args.manifest
+        )
+    except ValueError as e:
+        # Raised by check_frame_sizes before ffmpeg is started
+        print(f"Error: {e}")
 
 if __name__ == "__main__":
     main()
@@ -1,22 +1,518 @@
 import argparse
+import errno
 import json
 import os
+import queue
 import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pdal
+from numpy.lib.recfunctions import repack_fields, structured_to_unstructured
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional, prepare_frame falls back to numpy
+    njit = None
+
+try:
+    import fcntl
+except ImportError:  # Windows, pipes keep their default buffer size
+    fcntl = None
+
+
+MAX_8BIT = 255
+
+# Frames are prepared by a thread pool (numpy releases the GIL) while the
+# main thread writes the previous ones to ffmpeg's stdin.
+MAX_WORKERS = 4
+MAX_PENDING_FRAMES = MAX_WORKERS
+
+# Prepared frames each writer thread may have queued behind the one it writes.
+WRITER_QUEUE_FRAMES = 2
+
+# Points read per PDAL streaming chunk.
+STREAM_CHUNK_SIZE = 1_000_000
+
+# Fields needed to build the frames; the rest of the PDAL record is dropped while reading.
+FRAME_FIELDS = ("Z", "Red", "Green", "Blue", "Classification", "PointSourceId")
+
+# Points per band of rows packed at once by the numpy fallback: a band's input
+# columns, temporaries, yuv420p scratch and output bytes (about 48 per point)
+# then fit in a 256 KiB L2 cache instead of every pass streaming the whole frame.
+TILE_POINTS = 256 * 1024 // 48
+
+# Frames ffmpeg may queue per pipe input (default 8), so a slow encoder does not
+# stall the writer threads between frames.
+PIPE_QUEUE_FRAMES = 64
+
+# Kernel buffer requested for each pipe to ffmpeg (the Linux default is 64 KiB).
+PIPE_BUFFER_SIZE = 1 << 20
+
+# Seconds between attempts to open the alpha FIFO while ffmpeg starts up.
+FIFO_OPEN_INTERVAL = 0.05
+
+# Video encoders selectable with --encoder. The hardware ones need an NVIDIA
+# GPU with AV1 NVENC or a VAAPI render node at VAAPI_DEVICE.
+ENCODERS = ("libvpx-vp9", "av1_nvenc", "vp9_vaapi")
+VAAPI_DEVICE = "/dev/dri/renderD128"
+
+# libvpx-vp9 speed under the "good" deadline; higher is faster at some cost in quality
+VP9_CPU_USED = 4
 
 
 def run_pipeline(input_path):
-    """Run PDAL pipeline to read LAS and return a numpy structured array."""
+    """
+    Stream the LAS through PDAL in chunks and return a structured array of
+    FRAME_FIELDS only, so the full records are never held for the whole file
+    """
     pipeline_json = {
         "pipeline": [
             {"type": "readers.las", "filename": input_path}
         ]
     }
     pipe = pdal.Pipeline(json.dumps(pipeline_json))
-    pipe.execute()
-    return pipe.arrays[0]
+    chunks = [
+        repack_fields(chunk[list(FRAME_FIELDS)])
+        for chunk in pipe.iterator(chunk_size=STREAM_CHUNK_SIZE)
+    ]
+    return np.concatenate(chunks)
+
+
+def color_max(arr):
+    """Largest Red/Green/Blue value, reduced as one strided (n, 3) view instead of three passes."""
+    rgb = structured_to_unstructured(arr[['Red', 'Green', 'Blue']], copy=False)
+    return rgb.max()
+
+
+def sort_by_point_source_id(arr):
+    """
+    Sort once by PointSourceId into plain contiguous FRAME_FIELDS columns,
+    so each frame is a unit-stride slice instead of a masked copy of every field
+    """
+    order = np.argsort(arr['PointSourceId'], kind='stable')
+    columns = {name: arr[name][order] for name in FRAME_FIELDS}
+    sorted_ids = columns['PointSourceId']
+    # A frame starts wherever the sorted id changes: one linear pass instead
+    # of np.unique (another sort) plus a binary search per frame
+    change = np.empty(sorted_ids.size, dtype=bool)
+    change[:1] = True
+    np.not_equal(sorted_ids[1:], sorted_ids[:-1], out=change[1:])
+    starts = np.flatnonzero(change)
+    point_source_ids = sorted_ids[starts]
+    bounds = np.append(starts, sorted_ids.size)
+    return point_source_ids, bounds, columns
+
+
+def check_frame_sizes(point_source_ids, counts, width, height):
+    """Raise for the first PointSourceId whose point count is not width * height."""
+    expected_n = width * height
+    wrong = np.flatnonzero(counts != expected_n)
+    if wrong.size:
+        i = wrong[0]
+        raise ValueError(
+            f"Frame {point_source_ids[i]}: expected {expected_n} points but got {counts[i]}."
+        )
+
+
+def scale_color(channel, max_rgb, out, scratch=None):
+    """
+    Normalize a 16-bit LAS color channel to 0–255 into the uint8 array out,
+    using the float32 array scratch (same shape) for the general scale
+    """
+    if max_rgb == 65_535:
+        # Full 16-bit range: the high byte is the 8-bit color
+        np.right_shift(channel, 8, out=out, casting='unsafe')
+    elif max_rgb == MAX_8BIT or max_rgb <= 1.0:
+        # Already 0–255 (8-bit colors in 16-bit fields), or left as is
+        out[...] = channel
+    else:
+        # Dividing by the clip maximum already lands in 0–1, so no clipping
+        scaled = np.divide(channel, np.float32(max_rgb), out=scratch, dtype=np.float32)
+        np.multiply(scaled, 255, out=scaled)
+        np.copyto(out, scaled, casting='unsafe')
+    return out
+
+
+def color_lut(max_rgb):
+    """scale_color of every 16-bit value, so the compiled kernel only does a lookup."""
+    return scale_color(np.arange(65536, dtype=np.uint16), max_rgb, np.empty(65536, dtype=np.uint8))
+
+
+if njit is not None:
+    @njit(nogil=True, cache=True)
+    def rgb_to_yuv420p_kernel(rgb, yuv):
+        """rgb_to_yuv420p of a whole (H, W, 3) frame into the flat yuv420p buffer yuv."""
+        height, width, _ = rgb.shape
+        chroma_height, chroma_width = (height + 1) // 2, (width + 1) // 2
+        u_offset = height * width
+        v_offset = u_offset + chroma_height * chroma_width
+        for row in range(height):
+            for col in range(width):
+                r = np.int32(rgb[row, col, 0])
+                g = np.int32(rgb[row, col, 1])
+                b = np.int32(rgb[row, col, 2])
+                yuv[row * width + col] = ((66 * r + 129 * g + 25 * b + 128) >> 8) + 16
+        # Edge pixels repeated when a dimension is odd
+        for chroma_row in range(chroma_height):
+            upper = 2 * chroma_row
+            lower = min(upper + 1, height - 1)
+            for chroma_col in range(chroma_width):
+                left = 2 * chroma_col
+                right = min(left + 1, width - 1)
+                r = (np.int32(rgb[upper, left, 0]) + np.int32(rgb[upper, right, 0])
+                     + np.int32(rgb[lower, left, 0]) + np.int32(rgb[lower, right, 0]) + 2) >> 2
+                g = (np.int32(rgb[upper, left, 1]) + np.int32(rgb[upper, right, 1])
+                     + np.int32(rgb[lower, left, 1]) + np.int32(rgb[lower, right, 1]) + 2) >> 2
+                b = (np.int32(rgb[upper, left, 2]) + np.int32(rgb[upper, right, 2])
+                     + np.int32(rgb[lower, left, 2]) + np.int32(rgb[lower, right, 2]) + 2) >> 2
+                i = chroma_row * chroma_width + chroma_col
+                yuv[u_offset + i] = ((-38 * r - 74 * g + 112 * b + 128) >> 8) + 128
+                yuv[v_offset + i] = ((112 * r - 94 * g - 18 * b + 128) >> 8) + 128
+
+    # nogil rather than parallel: the worker pool already runs one frame per
+    # thread, and numba's default threading layer rejects concurrent launches
+    @njit(nogil=True, cache=True)
+    def pack_frame_kernel(z, red, green, blue, classification, lut, combined_array, yuv_array, alpha_array):
+        """
+        Scale and split depth, normalize colors and compute alpha for both
+        frames in a single pass, then convert the color frame to yuv420p
+        """
+        height, double_width, _ = combined_array.shape
+        width = double_width // 2
+        for row in range(height):
+            for col in range(width):
+                i = row * width + col
+                d = np.uint32(min(abs(np.float32(z[i]) * np.float32(1000.0)), np.float32(16_777_215.0)))
+                combined_array[row, col, 0] = (d >> 16) & 0xFF
+                combined_array[row, col, 1] = (d >> 8) & 0xFF
+                combined_array[row, col, 2] = d & 0xFF
+                combined_array[row, width + col, 0] = lut[red[i]]
+                combined_array[row, width + col, 1] = lut[green[i]]
+                combined_array[row, width + col, 2] = lut[blue[i]]
+                a = 0 if classification[i] == 7 else 255
+                alpha_array[row, col] = a
+                alpha_array[row, width + col] = a
+        rgb_to_yuv420p_kernel(combined_array, yuv_array)
+else:
+    pack_frame_kernel = None
+
+
+def rgb_to_yuv420p(rgb, y_plane, u_plane, v_plane, luma, chroma):
+    """
+    Convert an (H, W, 3) rgb24 band that starts on an even frame row into its
+    rows of the yuv420p planes with BT.601 limited-range coefficients, the
+    conversion ffmpeg would otherwise do, in the int32 scratch luma (2, H, W)
+    and chroma (5, (H + 1) // 2, W // 2)
+    """
+    r, g, b = rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2]
+    y, term = luma
+    np.multiply(r, 66, out=y, dtype=np.int32)
+    np.multiply(g, 129, out=term, dtype=np.int32)
+    y += term
+    np.multiply(b, 25, out=term, dtype=np.int32)
+    y += term
+    # ((y + 128) >> 8) + 16 in one shift, the offset being a multiple of 256
+    y += 128 + (16 << 8)
+    y >>= 8
+    np.copyto(y_plane, y, casting='unsafe')
+
+    # Chroma from the rounded mean of each 2x2 block. Frames are 2*W wide, so
+    # only the height can be odd: the last row then stands in for the one below
+    sums, (u, term) = chroma[:3], chroma[3:]
+    upper, lower = rgb[0::2], rgb[1::2]
+    full = lower.shape[0]
+    for k, block_sum in enumerate(sums):
+        np.add(upper[:, 0::2, k], upper[:, 1::2, k], out=block_sum, dtype=np.int32)
+        block_sum[full:] *= 2
+        block_sum[:full] += lower[:, 0::2, k]
+        block_sum[:full] += lower[:, 1::2, k]
+        block_sum += 2
+        block_sum >>= 2
+    r, g, b = sums
+    np.multiply(r, -38, out=u)
+    np.multiply(g, 74, out=term)
+    u -= term
+    np.multiply(b, 112, out=term)
+    u += term
+    u += 128 + (128 << 8)
+    u >>= 8
+    np.copyto(u_plane, u, casting='unsafe')
+    # V reuses the U scratch
+    v = u
+    np.multiply(r, 112, out=v)
+    np.multiply(g, 94, out=term)
+    v -= term
+    np.multiply(b, 18, out=term)
+    v -= term
+    v += 128 + (128 << 8)
+    v >>= 8
+    np.copyto(v_plane, v, casting='unsafe')
+
+
+def yuv420p_planes(yuv, width, height):
+    """The (H, W) Y and ((H + 1) // 2, (W + 1) // 2) U and V planes of the flat yuv420p buffer yuv."""
+    chroma_height, chroma_width = (height + 1) // 2, (width + 1) // 2
+    luma_size, chroma_size = height * width, chroma_height * chroma_width
+    y_plane = yuv[:luma_size].reshape((height, width))
+    u_plane = yuv[luma_size:luma_size + chroma_size].reshape((chroma_height, chroma_width))
+    v_plane = yuv[luma_size + chroma_size:].reshape((chroma_height, chroma_width))
+    return y_plane, u_plane, v_plane
+
+
+def yuv420p_size(width, height):
+    """Bytes in one yuv420p frame of width x height."""
+    return width * height + 2 * ((width + 1) // 2) * ((height + 1) // 2)
+
+
+def pack_tile(tile, max_rgb, combined_array, alpha_array, yuv_planes, scratch, depth, luma, chroma):
+    """
+    Fill a band of rows of the color and alpha frames (combined_array and
+    alpha_array) from the points of tile, the same rows of the subset, and
+    convert the color rows into their rows of yuv_planes, using the float32
+    scratch, '>u4' depth and int32 luma/chroma arrays of the band
+    """
+    height, double_width, _ = combined_array.shape
+    width = double_width // 2
+
+    # Depth
+    # Split 24 bit variable into 3x8-bit channels (R, G, B) 
+    # Scaled in the float32 scratch and truncated into the big-endian depth
+    # scratch, so no frame-sized temporaries (tile['Z'] is a view of the column)
+    Z = depth.reshape(-1)
+    z_scaled = scratch.reshape(-1)
+    np.multiply(tile['Z'], 1000, out=z_scaled, dtype=np.float32)
+    np.abs(z_scaled, out=z_scaled)
+    # abs already made it non-negative, so only the upper bound is left
+    np.minimum(z_scaled, 16_777_215, out=z_scaled)
+    np.copyto(Z, z_scaled, casting='unsafe')
+
+    # Big-endian bytes of each value, so the channels below are views, not shift passes
+    Z_bytes = Z.view(np.uint8).reshape(-1, 4)
+
+    # 8 MSBs -> Red Channel
+    Z_R = Z_bytes[:, 1]
+
+    # Middle 8 bits -> Green Channel
+    Z_G = Z_bytes[:, 2]
+
+    # 8 LSBs -> Blue Channel
+    Z_B = Z_bytes[:, 3]
+
+    # Colors, written straight into the right half of the frame
+    color_array = combined_array[:, width:]
+    channels = (tile['Red'], tile['Green'], tile['Blue'])
+
+    # Normalize if LAS stores 0–65535 or other scaling (max_rgb is per clip)
+    for k, channel in enumerate(channels):
+        scale_color(channel.reshape((height, width)), max_rgb, color_array[:, :, k], scratch)
+
+    # Numpy array (H, 2*W, 3), filled channel by channel: depth on the
+    # left half (color is already in the right), with no stack or concatenate copies
+    combined_array[:, :width, 0] = Z_R.reshape((height, width))
+    combined_array[:, :width, 1] = Z_G.reshape((height, width))
+    combined_array[:, :width, 2] = Z_B.reshape((height, width))
+
+    # Numpy array (H, 2*W), the same alpha mask behind both halves,
+    # computed from classification straight into the left half as 0/255 bytes
+    A_image_array = alpha_array[:, :width]
+    np.not_equal(tile['Classification'].reshape((height, width)), 7, out=A_image_array)
+    A_image_array *= MAX_8BIT
+    alpha_array[:, width:] = A_image_array
+
+    # yuv420p while the band's color rows are still in cache
+    rgb_to_yuv420p(combined_array, *yuv_planes, luma, chroma)
+
+
+def tile_rows(width, height):
+    """
+    Rows per band of the numpy fallback, about TILE_POINTS points and even,
+    so only the last band can end halfway through a row of chroma blocks
+    """
+    return min(height, max(2, TILE_POINTS // width // 2 * 2))
+
+
+def prepare_frame(subset, width, height, max_rgb, lut, combined_array, yuv_array, alpha_array,
+                  scratch, depth, luma, chroma):
+    """
+    Fill the preallocated (H, 2*W, 3) color and (H, 2*W) alpha frames for one
+    PointSourceId and return byte views of the color frame converted to
+    yuv420p and of the alpha frame
+    """
+    if pack_frame_kernel is not None:
+        pack_frame_kernel(subset['Z'], subset['Red'], subset['Green'], subset['Blue'],
+                          subset['Classification'], lut, combined_array, yuv_array, alpha_array)
+        return memoryview(yuv_array).cast('B'), memoryview(alpha_array).cast('B')
+
+    # numpy fallback, a band of rows at a time so each band stays in cache
+    rows = tile_rows(width, height)
+    y_plane, u_plane, v_plane = yuv420p_planes(yuv_array, 2 * width, height)
+    for top in range(0, height, rows):
+        bottom = min(top + rows, height)
+        # Bands start on even rows, so each owns rows top // 2 onwards of the chroma
+        chroma_top, chroma_bottom = top // 2, (bottom + 1) // 2
+        tile = {name: column[top * width:bottom * width] for name, column in subset.items()}
+        yuv_planes = (y_plane[top:bottom], u_plane[chroma_top:chroma_bottom],
+                      v_plane[chroma_top:chroma_bottom])
+        pack_tile(tile, max_rgb, combined_array[top:bottom], alpha_array[top:bottom], yuv_planes,
+                  scratch[:bottom - top], depth[:bottom - top],
+                  luma[:, :bottom - top], chroma[:, :chroma_bottom - chroma_top])
+
+    # Zero-copy byte views of the NumPy arrays (yuv420p and gray formats)
+    return memoryview(yuv_array).cast('B'), memoryview(alpha_array).cast('B')
+
+
+def prepared_frames(executor, frames, width, height, max_rgb):
+    """
+    Yield the raw frames in order while the executor prepares up to
+    MAX_PENDING_FRAMES ahead, so numpy work overlaps the ffmpeg writes
+    """
+    point_source_ids, bounds, columns = frames
+    # The compiled kernel normalizes colors through one table for the clip
+    lut = color_lut(max_rgb) if pack_frame_kernel is not None else None
+    # Frame buffers reused round-robin. The writers get views, not copies, so a
+    # buffer is busy from submission until written: up to MAX_PENDING_FRAMES
+    # futures (the new one included), WRITER_QUEUE_FRAMES queued and one being
+    # written
+    buffers = [
+        (np.empty((height, 2 * width, 3), dtype=np.uint8),
+         np.empty(yuv420p_size(2 * width, height), dtype=np.uint8),
+         np.empty((height, 2 * width), dtype=np.uint8))
+        for _ in range(MAX_PENDING_FRAMES + WRITER_QUEUE_FRAMES + 1)
+    ]
+    # Written as flat byte views (memoryview(...).cast('B')), which needs each
+    # buffer to be one C-contiguous block rather than a strided copy
+    assert all(buffer.flags['C_CONTIGUOUS'] for slot in buffers for buffer in slot)
+    # float32, depth and yuv420p band scratch for the numpy path, only needed
+    # while a frame is being prepared, so one set per pending future is enough
+    rows = tile_rows(width, height)
+    scratches = [
+        (np.empty((rows, width), dtype=np.float32), np.empty((rows, width), dtype='>u4'),
+         np.empty((2, rows, 2 * width), dtype=np.int32),
+         np.empty((5, (rows + 1) // 2, width), dtype=np.int32))
+        if pack_frame_kernel is None else (None, None, None, None)
+        for _ in range(MAX_PENDING_FRAMES + 1)
+    ]
+    pending = deque()
+    for i in range(point_source_ids.size):
+        lo, hi = bounds[i], bounds[i + 1]
+        subset = {name: column[lo:hi] for name, column in columns.items()}
+        combined_array, yuv_array, alpha_array = buffers[i % len(buffers)]
+        scratch, depth, luma, chroma = scratches[i % len(scratches)]
+        pending.append(executor.submit(
+            prepare_frame, subset, width, height, max_rgb, lut,
+            combined_array, yuv_array, alpha_array, scratch, depth, luma, chroma))
+        if len(pending) >= MAX_PENDING_FRAMES:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def grow_pipe_buffer(fd):
+    """Raise the kernel buffer of pipe fd to PIPE_BUFFER_SIZE where Linux allows it."""
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return
+    try:
+        # F_SETPIPE_SZ is only exported by fcntl from Python 3.10
+        fcntl.fcntl(fd, getattr(fcntl, "F_SETPIPE_SZ", 1031), PIPE_BUFFER_SIZE)
+    except OSError:
+        # Above /proc/sys/fs/pipe-max-size for this user; keep the default
+        pass
+
+
+def open_fifo(pipe_name, process):
+    """
+    Open the FIFO pipe_name for writing once ffmpeg has opened it for reading,
+    raising BrokenPipeError if ffmpeg exits first instead of blocking forever
+    """
+    while True:
+        try:
+            fd = os.open(pipe_name, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            # ENXIO: no reader yet
+            if e.errno != errno.ENXIO:
+                raise
+            if process.poll() is not None:
+                raise BrokenPipeError(f"ffmpeg exited before opening {pipe_name}") from e
+            time.sleep(FIFO_OPEN_INTERVAL)
+        else:
+            os.set_blocking(fd, True)
+            return fd
+
+
+def write_to_pipe(pipe_name, frames_bytes, process):
+    print(f"Starting write to {pipe_name}...")
+    try:
+        # Write straight to the pipe fd; frames are far larger than the
+        # BufferedWriter buffer, so it would only add a layer per write
+        fd = open_fifo(pipe_name, process)
+        grow_pipe_buffer(fd)
+        try:
+            for frame_bytes in frames_bytes:
+                view = memoryview(frame_bytes).cast("B")
+                while view:
+                    view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+    except BrokenPipeError:
+        print(f"Pipe {pipe_name} was closed by the reader (ffmpeg) prematurely.")
+    except Exception as e:
+        print(f"Error writing to pipe {pipe_name}: {e}")
+    # Keep draining so the producer never blocks on a full queue
+    for _ in frames_bytes:
+        pass
+    print(f"Finished writing to {pipe_name}.")
+
+
+def write_to_stdin(stdin, frames_bytes):
+    """
+    Write the frames to ffmpeg's stdin from a dedicated thread, so a pipe
+    blocked by the encoder does not hold up preparing the next frames
+    """
+    try:
+        for frame_bytes in frames_bytes:
+            # stdin is unbuffered, so a write may be partial
+            view = memoryview(frame_bytes).cast("B")
+            while view:
+                view = view[stdin.write(view):]
+    except BrokenPipeError:
+        print("FFmpeg closed its stdin prematurely.")
+    except Exception as e:
+        print(f"Error writing to FFmpeg's stdin: {e}")
+    # Keep draining so the producer never blocks on a full queue
+    for _ in frames_bytes:
+        pass
+
+
+def video_codec_args(encoder, stream, pix_fmt, frame_width, threads):
+    """
+    ffmpeg codec and rate control arguments for output video stream `stream`,
+    with libvpx-vp9 encoding rows and tile columns on `threads` threads
+    (0 lets libvpx choose)
+    """
+    spec = f":v:{stream}"
+    if encoder == "av1_nvenc":
+        # Constant quality, the NVENC counterpart of -crf; NVENC has no gray
+        # input, so alpha is sent as yuv420p with neutral chroma
+        return [f"-c{spec}", "av1_nvenc", f"-pix_fmt{spec}", "yuv420p",
+                f"-rc{spec}", "vbr", f"-cq{spec}", "25", f"-b{spec}", "0"]
+    if encoder == "vp9_vaapi":
+        # Frames are uploaded to the device as nv12 and encoded at constant QP
+        return [f"-filter{spec}", "format=nv12,hwupload", f"-c{spec}", "vp9_vaapi",
+                f"-rc_mode{spec}", "CQP", f"-global_quality{spec}", "100"]
+    # Tile columns are given as log2: one per thread, but a VP9 tile is at least
+    # 256 pixels wide and there are at most 2^6 of them
+    tile_columns = max(0, min(6, (frame_width // 256).bit_length() - 1))
+    if threads:
+        tile_columns = min(tile_columns, threads.bit_length() - 1)
+    return [f"-c{spec}", "libvpx-vp9", f"-pix_fmt{spec}", pix_fmt, f"-b{spec}", "0",
+            f"-crf{spec}", "25", f"-threads{spec}", str(threads), f"-row-mt{spec}", "1",
+            f"-tile-columns{spec}", str(tile_columns), f"-frame-parallel{spec}", "1",
+            f"-deadline{spec}", "good", f"-cpu-used{spec}", str(VP9_CPU_USED)]
 
 
 def encode_multiple_frames_with_alpha_to_av1(
@@ -25,7 +521,10 @@ def encode_multiple_frames_with_alpha_to_av1(
         height,
         fps,
         output_dir,
-        manifest_path):
+        manifest_path,
+        max_rgb,
+        encoder="libvpx-vp9",
+        threads=1):
     """
     Group by PointSourceId to get a sequence of RGBAZ frames 
     and encodes the frames as an 8-bit AV1 video file using the yuva444p format
@@ -37,59 +536,63 @@ def encode_multiple_frames_with_alpha_to_av1(
     os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
 
     # Prepare some variables
-    point_source_ids = np.unique(arr['PointSourceId'])
-    expected_n = width * height
+    frames = sort_by_point_source_id(arr)
+    point_source_ids = frames[0]
+    # Every frame must fill the image; check them all before ffmpeg starts
+    check_frame_sizes(point_source_ids, np.diff(frames[1]), width, height)
     file_name = "RGBAZ.webm"
     file_path = os.path.join(output_dir, file_name)
-    MAX_8BIT = 255
+
+    # Color goes through stdin, alpha through a named pipe (FIFO), so ffmpeg
+    # gets both planes as raw inputs and needs no split/alphaextract filter
+    alpha_pipe_path = './pipe_alpha'
+    try:
+        os.mkfifo(alpha_pipe_path)
+    except FileExistsError:
+        print("Named pipe already exists.")
 
     # Define FFmpeg Command
     ffmpeg_command = [
         "ffmpeg",
+        # --- Global Flags ---
+        *(["-vaapi_device", VAAPI_DEVICE] if encoder == "vp9_vaapi" else []),
         # --- Input Flags (MUST come before -i) ---
         "-f",
         "rawvideo",
         "-pix_fmt",
-        "rgba",  # Input is 4-channel 8-bit RGBA
+        "yuv420p",  # Input 0 is the RGB frame already converted to 8-bit 4:2:0
         "-s",
         f"{2*width}x{height}",
         "-framerate",
         str(fps),
+        "-thread_queue_size",
+        str(PIPE_QUEUE_FRAMES),
         "-i",
         "pipe:0",  # Read raw data from standard input
-
-        # --- Video Filter Complex (Splits the RGBA stream) ---
-        "-filter_complex",
-        (
-            "[0:v]split[color][alpha];"  # Split the input stream into two named streams
-            "[color]format=yuv420p[c];"  # Stream 1: Keep color, convert to standard YUV
-            "[alpha]alphaextract,format=gray[a]" # Stream 2: Extract Alpha, convert to Grayscale
-        ),
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "gray",  # Input 1 is the 8-bit alpha mask
+        "-s",
+        f"{2*width}x{height}",
+        "-framerate",
+        str(fps),
+        "-thread_queue_size",
+        str(PIPE_QUEUE_FRAMES),
+        "-i",
+        alpha_pipe_path,
 
         # --- Stream 0 (Color Track) ---
         "-map",
-        "[c]",
-        "-c:v:0",
-        "libvpx-vp9",
-        "-pix_fmt",
-        "yuv420p",
-        "-b:v:0",
-        "0",
-        "-crf",
-        "25",
+        "0:v",
+        *video_codec_args(encoder, 0, "yuv420p", 2 * width, threads),
 
         # --- Stream 1 (Alpha Track) ---
         "-map",
-        "[a]",
-        "-c:v:1",
-        "libvpx-vp9", # Use the same codec for the alpha track
-        "-pix_fmt",
-        "gray",     # Grayscale format for the alpha channel
-        "-b:v:1",
-        "0",
-        "-crf",
-        "25",
-        
+        "1:v",
+        # Use the same codec for the alpha track, grayscale where supported
+        *video_codec_args(encoder, 1, "gray", 2 * width, threads),
+
         # --- Output File ---
         "-c:a",
         "copy",
@@ -111,70 +614,47 @@ def encode_multiple_frames_with_alpha_to_av1(
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=None,
+            # Unbuffered: the frames are written straight from their ring buffers
+            bufsize=0,
+        )
+        grow_pipe_buffer(process.stdin.fileno())
+
+        # The alpha frames are handed to a writer thread feeding the FIFO
+        alpha_frames = queue.Queue(maxsize=WRITER_QUEUE_FRAMES)
+        alpha_thread = threading.Thread(
+            target=write_to_pipe, args=(alpha_pipe_path, iter(alpha_frames.get, None), process)
+        )
+        alpha_thread.start()
+
+        # A writer thread owns stdin, so frames keep being prepared while
+        # ffmpeg holds the pipe
+        stdin_frames = queue.Queue(maxsize=WRITER_QUEUE_FRAMES)
+        stdin_thread = threading.Thread(
+            target=write_to_stdin, args=(process.stdin, iter(stdin_frames.get, None))
         )
+        stdin_thread.start()
+
+        try:
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                raw_frames = prepared_frames(executor, frames, width, height, max_rgb)
+                for i, (raw_frame_bytes, alpha_frame_bytes) in enumerate(raw_frames):
+                    alpha_frames.put(alpha_frame_bytes)
+
+                    # Hand the raw frame data to the stdin writer
+                    stdin_frames.put(raw_frame_bytes)
+
+                    if (i + 1) % (fps * 2) == 0:
+                        print(f"  Piped {i + 1} frames...")
+        finally:
+            stdin_frames.put(None)
+            alpha_frames.put(None)
+            stdin_thread.join()
+            # Close stdin before waiting on the alpha writer: ffmpeg reads the two
+            # inputs in lockstep, so the last color frames must reach it for the
+            # alpha FIFO to drain
+            process.stdin.close()
+            alpha_thread.join()
 
-        for i, pid in enumerate(point_source_ids):
-            subset = arr[arr['PointSourceId'] == pid]
-            n = subset.size
-
-            if n != expected_n:
-                raise ValueError(
-                    f"Frame {pid}: expected {expected_n} points but got {n}."
-                )
-
-            # Depth
-            # Split 24 bit variable into 3x8-bit channels (R, G, B) 
-            Z = np.clip(np.abs(subset['Z'].astype(np.float32) * 1000), 0, 16_777_215).astype(np.uint32)
-            
-            # 8 MSBs -> Red Channel
-            Z_R = ((Z >> 16) & MAX_8BIT).astype(np.uint8)
-            
-            # Middle 8 bits -> Green Channel
-            Z_G = ((Z >> 8) & MAX_8BIT).astype(np.uint8)
-            
-            # 8 LSBs -> Blue Channel
-            Z_B = (Z & MAX_8BIT).astype(np.uint8)
-            
-            # Colors
-            R = subset['Red'].astype(np.float32)
-            G = subset['Green'].astype(np.float32)
-            B = subset['Blue'].astype(np.float32)
-
-            # Normalize if LAS stores 0–65535 or other scaling
-            max_rgb = max(R.max(), G.max(), B.max())
-            if max_rgb > 1.0:
-                R = np.clip(np.clip(R / max_rgb, 0.0, 1.0) * 255, 0, 255).astype(np.uint8)
-                G = np.clip(np.clip(G / max_rgb, 0.0, 1.0) * 255, 0, 255).astype(np.uint8)
-                B = np.clip(np.clip(B / max_rgb, 0.0, 1.0) * 255, 0, 255).astype(np.uint8)
-
-            # Compute alpha based on classification
-            classification = subset['Classification']
-            A = np.clip(np.where(classification == 7, 0.0, 1.0).astype(np.float32) * 255, 0, 255).astype(np.uint8)
-
-            # Numpy array (H, W, 4)
-            ZZZA_stacked_array = np.stack([Z_R, Z_G, Z_B, A], axis=0)
-            ZZZA_transposed_array = np.transpose(ZZZA_stacked_array)
-            ZZZA_final_image_array = ZZZA_transposed_array.reshape((height, width, 4))
-
-            # Numpy array (H, W, 4)
-            RGBA_stacked_array = np.stack([R, G, B, A], axis=0)
-            RGBA_transposed_array = np.transpose(RGBA_stacked_array)
-            RGBA_final_image_array = RGBA_transposed_array.reshape((height, width, 4))
-
-            # Numpy array (H, 2*W, 4)
-            combined_array = np.concatenate((ZZZA_final_image_array, RGBA_final_image_array), axis=1)
-
-            # Convert the NumPy array (H, 2*W, 4) to raw bytes (RGBA format)
-            raw_frame_bytes = combined_array.tobytes()
-
-            # Write the raw frame data to FFmpeg's stdin pipe
-            process.stdin.write(raw_frame_bytes)
-
-            if (i + 1) % (fps * 2) == 0:
-                print(f"  Piped {i + 1} frames...")
-
-        # Finalize and Close
-        process.stdin.close()
         print("Piping complete. Waiting for FFmpeg to finish encoding...")
 
         stdout, stderr = process.communicate()
@@ -192,6 +672,8 @@ def encode_multiple_frames_with_alpha_to_av1(
         )
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
+    finally:
+        os.remove(alpha_pipe_path)
 
     # Write manifest JSON
     with open(manifest_path, "w", encoding="utf-8") as mf:
@@ -201,6 +683,14 @@ def encode_multiple_frames_with_alpha_to_av1(
     print(f"Manifest written to {manifest_path}")
 
 
+def non_negative_int(value):
+    """argparse type for an integer >= 0"""
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"expected an integer >= 0, got {value}")
+    return number
+
+
 def main():
     parser = argparse.ArgumentParser(description="Split LAS by PointSourceId into binary frames")
     parser.add_argument("--input", required=True, help="Path to input LAS file")
@@ -209,12 +699,24 @@ def main():
     parser.add_argument("--fps", required=True, type=int, help="Frames per second")
     parser.add_argument("--output", default="../server/frames", help="Output directory for binary frames")
     parser.add_argument("--manifest", default="../server/manifest/frames.json", help="Manifest output path")
+    parser.add_argument("--encoder", default="libvpx-vp9", choices=ENCODERS,
+                        help="Video encoder; av1_nvenc and vp9_vaapi encode on the GPU")
+    parser.add_argument("--encoder-threads", type=non_negative_int, default=os.cpu_count() or 1,
+                        help="Threads per libvpx-vp9 stream, 0 for libvpx's choice (default: all cores)")
 
     args = parser.parse_args()
 
     arr = run_pipeline(args.input)
-    encode_multiple_frames_with_alpha_to_av1(
-        arr, args.width, args.height, args.fps, args.output, args.manifest)
+
+    # One color scale for the whole clip, so frames don't flicker
+    max_rgb = float(color_max(arr))
+    try:
+        encode_multiple_frames_with_alpha_to_av1(
+            arr, args.width, args.height, args.fps, args.output, args.manifest, max_rgb,
+            encoder=args.encoder, threads=args.encoder_threads)
+    except ValueError as e:
+        # Raised by check_frame_sizes before ffmpeg is started
+        print(f"Error: {e}")
 
 
 if __name__ == "__main__":